@@ -21,22 +21,48 @@
 #   network subsystem -> slaved computer.
 
 
+import bisect
+import collections
+import glob
+import logging
+import os
+import selectors
 import time
 import power as pwr
 import udpCommunication as udpcomms
-import fcntl
-import os
 import sys
+import threading
+from dataclasses import dataclass, field
+
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional, without it the kernels run as plain Python.
+    def njit(**kwargs):
+        return lambda func: func
+
+
+log = logging.getLogger("sunburn")
 
 
 # Constants
 
-# Use debug printouts
-DEBUG = 1
+# Log level, set SUNBURN_LOG=DEBUG in environment for debug printouts
+LOG_LEVEL = os.environ.get("SUNBURN_LOG", "INFO").upper()
 
 # Number of cores
 CORES = 4
 
+# Real cpu usage conversion values. These need to be changed if target
+# system has more or less than 4 cores.
+CORE_CONVERSION_MULTIPLIERS = [0, 4.0, 2.0, 1.34, 1.0]
+
+# Preset core power values in watts for Intel Core I3 4330.
+# These can be adjusted to match used processor.
+# Must be kept in ascending order, the number of cores is looked up from it
+# with bisect.
+CORE_LIMITS = [16, 31.0, 33.4, 47, 51.5]
+
 # Minimum power of system. Used as activation limit.
 MIN_POWER = 18
 # Deadzone value used deciding whether to change number of used cores or not.
@@ -50,8 +76,14 @@ CHANGE_DEADZONE = 1.5
 SHORT_AVG = 1
 LONG_AVG = 6
 
+# Control loop rate. Each round of measurements takes one period, the rest
+# of the period is slept away.
+CONTROL_HZ = 2
+PERIOD = 1.0 / CONTROL_HZ
+
 # Interval limit for performing adjustments. That is, how many rounds of
 # measurements are done before PID adjustment.
+# PID adjustment is done every ADJUST_INTERVAL + 1 rounds.
 # This has an effect on PID/system responsiveness.
 ADJUST_INTERVAL = 1
 
@@ -62,17 +94,133 @@ ON_LIMIT = 2
 # PID derivative time
 DT = 4
 
+# Rounds without a client status report after which the client is
+# considered unresponsive and its cpu use is taken as 0.
+STATUS_TIMEOUT = 2
+
+# Seconds the reader thread waits before receiving again when no message
+# was available. Kept well below PERIOD so a status reply is still picked
+# up in the round following the poll.
+READER_BACKOFF = 0.05
+
+# Send the control command and status poll of a round in a single datagram,
+# separated by a newline. Requires a client that splits received datagrams
+# on newlines, see README. Off by default; each message then goes in its
+# own datagram as before.
+BATCH_MSGS = False
+
+# cpufreq governor used on the controller host itself. The controller idles
+# most of the time, so the lowest power governor is sufficient.
+# Note: this is a system wide setting and stays in effect after the
+# controller exits. Set SUNBURN_GOVERNOR in environment to pick another
+# governor, or to an empty value to leave the host setting untouched.
+GOVERNOR = os.environ.get("SUNBURN_GOVERNOR", "powersave")
+
 # Modes
 MODE_AUTO = 0
 MODE_LIMIT_TEST = 1
 MODE_PWR_TEST = 2
 
 
-def real_cpu_use():
-    """ Calculates real CPU use. Basically measured CPU usage times the
-    multiplier based on number of active cores.
+# PID gains
+PID = collections.namedtuple("PID", "kp ki kd")
+
+def update_real_cpu_use(st):
+    """ Calculates real CPU use and caches it in st.real_cpu. Basically
+    measured CPU usage times the multiplier based on number of active cores.
+    Must be called whenever the number of active cores or the measured CPU
+    use changes.
+    """
+    cores = st.processor_limits[1]
+    st.real_cpu = CORE_CONVERSION_MULTIPLIERS[cores] * st.cpu_use
+
+
+def send_msg_batch(msgs):
+    """Send several client messages. With BATCH_MSGS they go in a single
+    datagram separated by newlines, otherwise one datagram per message.
     """
-    return core_conversion_multipliers[processor_limits[1]] * cpu_use
+    if BATCH_MSGS:
+        udpcomms.send_msg("\n".join(msgs))
+    else:
+        for msg in msgs:
+            udpcomms.send_msg(msg)
+
+
+class Inbox:
+    """Holds the latest client cpu use. Written by the reader thread,
+    taken by the control loop. Only the newest status matters for control,
+    older ones are overwritten.
+    """
+    __slots__ = ('lock', 'msg')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.msg = None
+
+    def put(self, msg):
+        """Replace the held payload with msg"""
+        with self.lock:
+            self.msg = msg
+
+    def take(self):
+        """Return the held payload and empty the inbox. None if empty."""
+        with self.lock:
+            msg = self.msg
+            self.msg = None
+        return msg
+
+
+def reader(inbox):
+    """Reader thread. Receives client messages and keeps the cpu use of the
+    latest valid status message in inbox, so the control loop never blocks
+    on the network.
+    udpcomms.wait_msg() returns None when no message is available. It may do
+    so immediately, so the thread backs off for READER_BACKOFF before trying
+    again instead of spinning. Receive errors are logged and the thread
+    keeps running.
+    """
+    while True:
+        try:
+            msg = udpcomms.wait_msg()
+        except Exception:
+            log.exception("Receiving client message failed")
+            msg = None
+        if msg is None:
+            time.sleep(READER_BACKOFF)
+            continue
+        head, _, rest = msg.partition(":")
+        if head == "status":
+            try:
+                inbox.put(float(rest))
+            except ValueError:
+                print("Received message contained invalid data")
+
+
+def get_governor():
+    """Returns current cpufreq scaling governor of the controller host, read
+    from the first cpu. Returns "unknown" if it can not be read.
+    """
+    try:
+        with open("/sys/devices/system/cpu/cpu0/cpufreq/" +
+                  "scaling_governor") as f:
+            return f.read().strip()
+    except OSError:
+        return "unknown"
+
+
+def set_governor(name):
+    """Set cpufreq scaling governor of all cpus of the controller host.
+    Requires root, failures are reported and otherwise ignored.
+    """
+    paths = glob.glob("/sys/devices/system/cpu/cpu[0-9]*/cpufreq/" +
+                      "scaling_governor")
+    for path in paths:
+        try:
+            with open(path, "w") as f:
+                f.write(name)
+        except OSError as e:
+            print("Could not set cpu governor: " + str(e))
+            return
 
 
 def readFloat():
@@ -95,7 +243,7 @@ def interface(mode, pid, processor_limits, manual_target):
     """
 
     print("Input command: (M)ode select/adjust " +
-          "- (P)ID adjust - Empty input cancels")
+          "- (P)ID adjust - (G)overnor select - Empty input cancels")
     key = input().lower()
     if key == "m":
         if not mode:
@@ -111,25 +259,29 @@ def interface(mode, pid, processor_limits, manual_target):
             elif key == "a":
                 # Automatic mode
                 mode = MODE_AUTO
+    # Controller cpu governor selection
+    elif key == "g":
+        print("Enter cpu governor name (" + get_governor() + ")")
+        name = input().strip()
+        if name:
+            set_governor(name)
     # PID value adjustment
     elif key == "p":
-        val = None
-        while(val is None):
-            print("Enter new proportional value (" + str(kp) + ")")
-            val = readFloat()
-        pid[0] = val
-        val = None
-        while(val is None):
-            print("Enter new integral value (" + str(ki) + ")")
-            val = readFloat()
-        pid[1] = val
-        val = None
-        while(val is None):
-            print("Enter new derivative value (" + str(kd) + ")")
-            val = readFloat()
-        pid[2] = val
+        kp = None
+        while(kp is None):
+            print("Enter new proportional value (" + str(pid.kp) + ")")
+            kp = readFloat()
+        ki = None
+        while(ki is None):
+            print("Enter new integral value (" + str(pid.ki) + ")")
+            ki = readFloat()
+        kd = None
+        while(kd is None):
+            print("Enter new derivative value (" + str(pid.kd) + ")")
+            kd = readFloat()
+        pid = PID(kp, ki, kd)
         print("New values (P, I, D): " +
-              str(pid[0]) + ", " + str(pid[1]) + ", " + str(pid[2]))
+              str(pid.kp) + ", " + str(pid.ki) + ", " + str(pid.kd))
 
     # Mode selections:
     # 1 Manual cpu/core limits
@@ -168,305 +320,438 @@ def interface(mode, pid, processor_limits, manual_target):
             i = readFloat()
         if i < 1:
             i = 0
+        manual_target = i
 
     # Return changed state
     return mode, pid, processor_limits, manual_target
 
 
-def adjust(target, measured, integral, pid, previous_error):
-    """PID. Calculates an adjustment value based on the given target and
-    current measured value.
-    Arguments: target value, measured value, integral, array of pid values
+@njit(cache=True)
+def adjust_kernel(target, measured, integral, kp, ki, kd, previous_error, dt):
+    """PID calculation on plain floats, compiled with Numba when available.
+    Returns adjustment, new integral, error and derivative.
     """
 
     # Normal PID calculations
     error = target - measured
-    new_integral = integral + error*DT
+    new_integral = integral + error*dt
     # Limit the integral min and max
-    if new_integral > 10:
-        new_integral = 10
-    elif new_integral < -10:
-        new_integral = -10
-    derivative = (error - previous_error)/DT
-    adjustment = pid[0] * error / 10 + pid[1] * integral / 10 + pid[2] * derivative / 10
-
-    if DEBUG:
-        print("** PID values:")
-        print("** TGT: " + str(target) + " - CURRENT: " + str(measured))
-        print("** Error: " + str(error) + " - Derivative: " + str(derivative) +
-              " - Integral: " +  str(integral))
-        print(adjustment)
-        print(adjustment)
+    if new_integral > 10.0:
+        new_integral = 10.0
+    elif new_integral < -10.0:
+        new_integral = -10.0
+    derivative = (error - previous_error)/dt
+    adjustment = kp * error / 10 + ki * integral / 10 + kd * derivative / 10
+    return adjustment, new_integral, error, derivative
 
-    return adjustment, new_integral, error
 
+def adjust(target, measured, integral, pid, previous_error):
+    """PID. Calculates an adjustment value based on the given target and
+    current measured value.
+    Arguments: target value, measured value, integral, PID gains
+    """
 
-def average(data):
-    """Average given array"""
-    return sum(data) / float(len(data))
+    adjustment, new_integral, error, derivative = adjust_kernel(
+        float(target), float(measured), float(integral),
+        float(pid.kp), float(pid.ki), float(pid.kd),
+        float(previous_error), float(DT))
 
+    log.debug("** PID values:")
+    log.debug("** TGT: %s - CURRENT: %s", target, measured)
+    log.debug("** Error: %s - Derivative: %s - Integral: %s",
+              error, derivative, integral)
+    log.debug("%s", adjustment)
+
+    return adjustment, new_integral, error
 
-def main():
-    """Main function. Init system and start measurement/adjustment/control cycle
-    Number of measurement rounds is defined by value of ADJUST_INTERVAL. Default
-    value is 1, which translates to cycle of two measurements per adjustment.
-    While running, the PID values can be adjusted via interface.
-    """
 
-    # Initial intervals and power control
-    adjust_interval = 0
-    powered = 0
-    power_counter = 0
+class RunningAvg:
+    """Sliding window average over the last n values. Values are kept in a
+    preallocated ring buffer along with a running sum of the window, so both
+    pushing a value and reading the average are constant time regardless of
+    window size. A window of one is kept as a plain scalar.
+    """
+    __slots__ = ('buf', 'total', 'i', 'full')
+
+    def __init__(self, n):
+        self.buf = [0.0] * n if n > 1 else None
+        self.total = 0
+        self.i = 0
+        self.full = False
+
+    def push(self, value):
+        """Add value to the window, overwriting the oldest value if full"""
+        buf = self.buf
+        if buf is None:
+            self.total = value
+            return
+        i = self.i
+        self.total += value - buf[i]
+        buf[i] = value
+        i += 1
+        if i == len(buf):
+            i = 0
+            self.full = True
+            # Resum once per lap so rounding errors of the running sum do
+            # not accumulate over long runs.
+            self.total = sum(buf)
+        self.i = i
+
+    def average(self):
+        """Average of the values currently in the window"""
+        if self.buf is None:
+            return self.total
+        n = len(self.buf) if self.full else self.i
+        if not n:
+            return 0
+        return self.total / float(n)
+
+
+def limit_table(core_limits, pairs):
+    """Precompute cpu limit interpolation for each number of active cores.
+    pairs[cores] is the (upper, lower) index pair into core_limits used with
+    that many cores. Returns lists of slopes and intercepts, so that
+    cpu limit = power * slope + intercept.
+    """
+    slopes = []
+    intercepts = []
+    for upper, lower in pairs:
+        slope = 100.0 / (core_limits[upper] - core_limits[lower])
+        slopes.append(slope)
+        intercepts.append(-core_limits[lower] * slope)
+    return slopes, intercepts
+
+
+# Cpu limit interpolation tables, indexed by the new number of cores.
+# Going up, the limit is interpolated between the new core and the one
+# below it.
+# Caveat: When going down, the max power of cores 1 & 2 and 3 & 4 are
+# within few watts due to HyperThreading. Thus the jump from comparing
+# idle to comparing core 2.
+UP_SLOPE, UP_INTERCEPT = limit_table(
+    CORE_LIMITS, [(max(c, 1), max(c, 1) - 1) for c in range(CORES + 1)])
+DN_SLOPE, DN_INTERCEPT = limit_table(
+    CORE_LIMITS, [(1, 0) if c < 2 else (2, 0) if c < 3 else (3, 2)
+                  for c in range(CORES + 1)])
+
+
+@dataclass
+class ControlState:
+    """State of the controller, shared by the control round functions"""
+    inbox: Inbox
+    debug: bool = False
+
+    # Round counter and power control
+    tick: int = 0
+    powered: int = 0
+    power_counter: int = 0
 
     # Mode of the system
     # Mode 0: Automatic (Default)
     # Mode 1: Test mode 1 - Manually set CPU/Core limits
     # Mode 2: Test mode 2 - Manually set power level target
-    mode = MODE_AUTO
+    mode: int = MODE_AUTO
 
     # Power budget value
-    budget = 0
+    budget: float = 0
 
     # Initial values for measurements
+    power_target: float = 0
+    usage_power: RunningAvg = field(
+        default_factory=lambda: RunningAvg(SHORT_AVG))
+    usage_power_avg: RunningAvg = field(
+        default_factory=lambda: RunningAvg(LONG_AVG))
+    supply_power: RunningAvg = field(
+        default_factory=lambda: RunningAvg(SHORT_AVG))
+    supply_power_avg: RunningAvg = field(
+        default_factory=lambda: RunningAvg(LONG_AVG))
+    cpu_use: float = 0
+    # Real cpu use, not used by the controller itself. Kept up to date for
+    # logging/telemetry consumers, see update_real_cpu_use().
+    real_cpu: float = 0
+    status_age: int = 0
 
-    power_target = 0
-    usage_power = [0]
-    usage_power_avg = [0]
+    # PID values
+    pid: PID = PID(19, 0.5, 1)
+    integral: float = 0
+    previous_error: float = 0
 
-    supply_power = [0]
-    supply_power_avg = [0]
+    # Processor limits = [cpu use limit in pct, number of active cores]
+    processor_limits: list = field(default_factory=lambda: [7, 0])
 
-    cpu_use = 0
+    # Power target value in manual mode
+    manual_power_target: float = 0
 
-    # PID values
-    pid[19, 0.5, 1]
 
-    integral = 0
-    previous_error = 0
+def read_status(st):
+    """Collect CPU data received from client since the last round. The
+    previous value is kept if no new status has arrived, until none has
+    arrived for STATUS_TIMEOUT rounds. Then the cpu use falls back to 0.
+    """
+    status = st.inbox.take()
+    if status is None:
+        st.status_age += 1
+        if st.status_age > STATUS_TIMEOUT:
+            st.cpu_use = 0
+    else:
+        st.status_age = 0
+        st.cpu_use = status
+    # Covers the core limit set through the interface as well
+    update_real_cpu_use(st)
 
-    # Real cpu usage conversion values. These need to be changed if target
-    # system has more or less than 4 cores.
-    core_conversion_multipliers = [0, 4.0, 2.0, 1.34, 1.0]
 
-    # Preset core power values in watts for Intel Core I3 4330.
-    # These can be adjusted to match used processor
-    core_limits = [16, 31.0, 33.4, 47, 51.5]
+def measure(st, supply=None):
+    """Run measurement routine and update the averaging windows and power
+    target. If supply is given it replaces the measured supply power.
+    """
+    pwr.measure()
+
+    # Retrieve the measured values from power subsystem.
+    # Result should be a namedtuple in form of:
+    # measurements(usage_voltage, usage_current, usage_power,
+    # supply_voltage, supply_current, supply_power)
+
+    measurements = pwr.get_measurements_tuple()
+    if supply is None:
+        supply = measurements.supply_power
+    usage = measurements.usage_power
+
+    # To smooth sudden spikes out, the power values are based on average
+    # over several measurements. The short term values is stored in
+    # supply_power and usage_power. The long term values in
+    # supply_power_average and usage_power_average.
+    # All of these are averages, but short term window is so small that
+    # this is basically one measurement, thus the naming.
+    # Oldest values drop out automatically once a window is full.
+    st.supply_power.push(supply)
+    st.supply_power_avg.push(supply)
+    st.usage_power.push(usage)
+    st.usage_power_avg.push(usage)
+
+    # Average used in adjustment and power control. The usage average
+    # is only calculated when needed.
+    st.power_target = st.supply_power.average()
+
+
+def adjust_limits(st):
+    """Adjustment routine
+    This compares the known core power values against the measured values
+    and adjusts the number of cores as needed. This greatly enhances the
+    adaptation speed to sudden changes in power supply.
+
+    Approximate a new value of cpu limit from following formula:
+    Core power demand / Core power range = cpu limit
+
+    or in this case:
+
+    (Target - Core lower limit) /
+    (Core upper limit - core lower limit) = cpu limit
+
+    This is by no means accurate, but sets the cpu use limit closer to
+    target, allowing the PID to get back into play faster
+    """
+    power_target = st.power_target
+    processor_limits = st.processor_limits
+
+    # Calculate and add adjustment to current processor limits
+    new_limit, st.integral, st.previous_error = adjust(
+        power_target, st.usage_power.average(), st.integral, st.pid,
+        st.previous_error)
+    processor_limits[0] += new_limit
+
+    # Look up the number of cores matching the power target straight
+    # from CORE_LIMITS. Going up, the first core whose power rating
+    # covers the target is used. Going down, the target must be
+    # below the rating of the next lower core by more than the
+    # deadzone. This allows some leeway before changing number of
+    # cores, preventing unnecessary jumps if the operating power is
+    # near the limits of the power ratings of two cores.
+    c = processor_limits[1]
+    up = min(bisect.bisect_left(CORE_LIMITS, power_target), CORES)
+    down = max(bisect.bisect_right(CORE_LIMITS,
+                                   power_target + CHANGE_DEADZONE), 1)
+
+    # Change upward, increase number of used cores and reduce cpu
+    # usage accordingly.
+    if up > c:
+        processor_limits[1] = up
+        processor_limits[0] = int(power_target * UP_SLOPE[up] +
+                                  UP_INTERCEPT[up])
+    # Change downward, reduce number of cores and increase cpu usage
+    elif down < c:
+        processor_limits[1] = down
+        log.debug("** Core limited - core limit now at : %s", down)
+
+        # Calculate value for cpu limit based on number of active
+        # cores. See DN_SLOPE for the pairings.
+        processor_limits[0] = int(power_target * DN_SLOPE[down] +
+                                  DN_INTERCEPT[down])
+
+        # If the current integral is aggressive, reduce it slightly
+        # to make life of PID easier.
+        if st.integral > 5:
+            st.integral -= 1
+
+    # Sanity checks, cpu limit of less than 7 % unachiavable due
+    # to CPUlimit limitations on clientside.
+
+    if processor_limits[0] > 100:
+        processor_limits[0] = 100
+    elif processor_limits[0] < 7:
+        processor_limits[0] = 7
+
+    update_real_cpu_use(st)
+
+
+def power_control(st):
+    """Computer startup/shutdown control, used if the system is not in
+    manual limit mode.
+    Compare current power to minimum power and increment/decrement
+    counter. Counter runs up while unpowered with enough power and
+    down while powered without, otherwise it is reset.
+    If counter exceeds limits, shutdown/startup client.
+    """
+    if st.power_target > MIN_POWER:
+        delta = 1
+    elif st.power_target < MIN_POWER:
+        delta = -1
+    else:
+        delta = 0
+    if delta == 0 or (delta > 0) == bool(st.powered):
+        st.power_counter = 0
+    else:
+        st.power_counter += delta
+
+    if st.power_counter > ON_LIMIT:
+        pwr.power_on()
+        st.processor_limits[1] = 1
+        update_real_cpu_use(st)
+        st.powered = 1
+
+    elif st.power_counter < -OFF_LIMIT:
+        pwr.power_off()
+        st.processor_limits[1] = 0
+        update_real_cpu_use(st)
+        udpcomms.send_msg("shutdown:")
+        st.powered = 0
+
+
+def finish_round(st):
+    """Issue commands to client and poll computer for status"""
+    if st.powered:
+        send_msg_batch(["control:" + str(st.processor_limits[1]) + ":" +
+                        str(st.processor_limits[0]),
+                        "status:"])
+
+    # Rough estimate of system accuracy in long run. Only used in debug
+    # printout.
+    if st.debug:
+        st.budget += st.power_target - st.usage_power.average()
+        log.debug("\n\n Current Power Budget: %s\n", st.budget)
+
+
+def _loop_auto(st, supply=None):
+    """Control round in automatic mode. If supply is given it replaces the
+    measured supply power.
+    """
+    read_status(st)
+    measure(st, supply)
+    # If adjustment interval is reached, adjust. The interval is tested
+    # first as most rounds skip this.
+    if st.tick % (ADJUST_INTERVAL + 1) == 0 and st.powered:
+        adjust_limits(st)
+    power_control(st)
+    finish_round(st)
+
+
+def _loop_limit(st):
+    """Control round in manual CPU/core limit mode. Bypasses all the
+    core/cpu adjustments and ensures that the computer is turned on.
+    """
+    read_status(st)
+    measure(st)
+    if not st.powered:
+        pwr.power_on()
+        st.powered = 1
+    finish_round(st)
 
-    # Processor limits = [cpu use limit in pct, number of active cores]
-    processor_limits[7, 0]
 
-    # Power target value in manual mode
-    manual_power_target = 0
+def _loop_pwr(st):
+    """Control round in manual power target mode. Same as automatic mode,
+    but the manually set power target replaces the solar system power.
+    """
+    _loop_auto(st, st.manual_power_target)
+
+
+# Control round function of each mode
+LOOPS = {MODE_AUTO: _loop_auto,
+         MODE_LIMIT_TEST: _loop_limit,
+         MODE_PWR_TEST: _loop_pwr}
+
+
+def main():
+    """Main function. Init system and start measurement/adjustment/control cycle
+    Number of measurement rounds is defined by value of ADJUST_INTERVAL. Default
+    value is 1, which translates to cycle of two measurements per adjustment.
+    While running, the PID values can be adjusted via interface.
+    """
 
-    # Init keypress detection
-    fl = fcntl.fcntl(sys.stdin.fileno(), fcntl.F_GETFL)
-    fcntl.fcntl(sys.stdin.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
+    # Init keypress detection. Not available if stdin can not be polled,
+    # e.g. /dev/null or a regular file when run as a service.
+    sel = selectors.DefaultSelector()
+    try:
+        sel.register(sys.stdin, selectors.EVENT_READ)
+    except (OSError, ValueError):
+        print("Input can not be polled, settings interface disabled")
+        sel = None
+
+    # Fall back to INFO on unknown level names
+    level = LOG_LEVEL
+    if not isinstance(logging.getLevelName(level), int):
+        print("Unknown log level " + level + ", using INFO")
+        level = "INFO"
+    logging.basicConfig(level=level, format="%(message)s")
 
     # Init the power system and ensure the power is off.
     pwr.init()
     pwr.power_off()
+    if GOVERNOR:
+        set_governor(GOVERNOR)
+
+    # Compile the PID kernel now rather than in the first adjustment round,
+    # which would stall the control cadence. No-op without Numba.
+    adjust_kernel(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0)
+
+    # Start receiving client status in the background
+    st = ControlState(inbox=Inbox(), debug=log.isEnabledFor(logging.DEBUG))
+    threading.Thread(target=reader, args=(st.inbox,), daemon=True).start()
 
     print("System started with default values: Press enter for settings")
 
+    # The round function is picked once per mode change instead of
+    # testing the mode throughout every round.
+    loop = LOOPS[st.mode]
+    _monotonic = time.monotonic
+    _sleep = time.sleep
+
     while(1):
+        t0 = _monotonic()
+        st.tick += 1
+
         # Detect keypress, activate settings
-        try:
-            stdin = sys.stdin.read()
-            if "\n" in stdin or "\r" in stdin:
-                mode, pid, processor_limits, manual_target = interface(mode, pid, processor_limits, manual_target)
-        except IOError:
-            pass
-
-        # Collect CPU data from client over network.
-        msg = udpcomms.wait_msg()
-        if msg is None:
-            cpu_use = 0
-        else:
-            data = msg.split(":")
-            if data[0] == "status":
-                try:
-                    cpu_use = float(data[1])
-                except ValueError:
-                    print("Received message contained invalid data")
-                    cpu_use = 0
-
-        # Run measurement routine
-        pwr.measure()
-
-        # Retrieve the measured values from power subsystem.
-        # Result should be a namedtuple in form of:
-        # measurements(usage_voltage, usage_current, usage_power,
-        # supply_voltage, supply_current, supply_power)
-
-        measurements = pwr.get_measurements_tuple()
-
-        # To smooth sudden spikes out, the power values are based on average
-        # over several measurements. The short term values is stored in
-        # supply_power and usage_power. The long term values in
-        # supply_power_average and usage_power_average.
-        # All of these are averages, but short term window is so small that
-        # this is basically one measurement, thus the naming.
-
-        # Log power from supply if system is not in manual control mode 2.
-        # Otherwise use the manually set power target
-        if mode < MODE_PWR_TEST:
-            supply_power.append(measurement.supply_power)
-            supply_power_avg.append(measurement.supply_power)
-        else:
-            supply_power.append(manual_power_target)
-            supply_power_avg.append(manual_power_target)
-
-        # Drop oldest values if the averaging window is full.
-        if len(supply_power) > SHORT_AVG:
-            supply_power.pop(0)
-            usage_power.pop(0)
-        if len(supply_power_avg) > LONG_AVG:
-            supply_power_avg.pop(0)
-            usage_power_avg.pop(0)
-
-        # Averages used in adjustment
-        power_target = average(supply_power)
-        power = average(usage_power)
-
-        # Adjustment routine
-        # This compares the known core power values against the measured values
-        # and adjusts the number of cores as needed. This greatly enhances the
-        # adaptation speed to sudden changes in power supply.
-
-        # Approximate a new value of cpu limit from following formula:
-        # Core power demand / Core power range = cpu limit
-        #
-        # or in this case:
-        #
-        # (Target - Core lower limit) /
-        # (Core upper limit - core lower limit) = cpu limit
-        #
-        # This is by no means accurate, but sets the cpu use limit closer to
-        # target, allowing the PID to get back into play faster
-
-        if mode != MODE_LIMIT_TEST and powered:
-
-            # If adjustment interval is reached, adjust.
-            if adjust_interval > ADJUST_INTERVAL:
-                adjust_interval = 0
-                # Calculate and add adjustment to current processor limits
-                new_limit, integral, previous_error = adjust(power_target, power, integral, pid, previous_error)
-                processor_limits[0] += new_limit
-
-                # Change upward, increase number of used cores and reduce cpu
-                # usage accordingly.
-                if power_target > core_limits[processor_limits[1]]:
-                    processor_limits[1] += 1
-                    if processor_limits[1] > CORES:
-                        processor_limits[1] = CORES
-                    else:
-                        upper = core_limits[processor_limits[1]]
-                        lower = core_limits[processor_limits[1] - 1]
-
-                        processor_limits[0] = int(((power_target - lower) /
-                                                  (upper - lower)) * 100)
-                # Change downward, reduce number of cores and increase cpu usage
-                elif processor_limits[1] > 1:
-
-                    # Allow some leeway before changing number of cores. This
-                    # prevents unnecessary jumps if there operating power is
-                    # near the limits of the power ratings of two cores.
-
-                    if power_target < (core_limits[processor_limits[1] - 1] -
-                                       CHANGE_DEADZONE):
-                        # Decrease number of cores, perform sanity checks
-                        processor_limits[1] -= 1
-                        if DEBUG:
-                            print("** Core limited - core limit now at : " +
-                                  str(processor_limits[1]))
-                        if processor_limits[1] < 1:
-                            processor_limits[1] = 1
-                        else:
-
-                            # Calculate value for cpu limit based on number of
-                            # active cores.
-                            # Caveat: When going down, the max power of
-                            # cores 1 & 2 and 3 & 4 are within few watts due to
-                            # HyperThreading. Thus the jump from comparing
-                            # idle to comparing core 2.
-
-                            if processor_limits[1] < 2:
-                                upper = core_limits[1]
-                                lower = core_limits[0]
-                            elif processor_limits[1] < 3:
-                                upper = core_limits[2]
-                                lower = core_limits[0]
-                            else:
-                                upper = core_limits[3]
-                                lower = core_limits[2]
-
-                            processor_limits[0] = int(((power_target - lower) /
-                                                      (upper - lower)) * 100)
-
-                            # If the current integral is aggressive, reduce it
-                            # slightly to make life of PID easier.
-                            if integral > 5:
-                                integral -= 1
-
-                # Sanity checks, cpu limit of less than 7 % unachiavable due
-                # to CPUlimit limitations on clientside.
-
-                if processor_limits[0] > 100:
-                    processor_limits[0] = 100
-                elif processor_limits[0] < 7:
-                    processor_limits[0] = 7
-
-        # Computer startup/shutdown control, used if the system is not in
-        # manual limit mode.
-        # This also ensures that the computer is turned on in mode 1.
-        if mode != MODE_LIMIT_TEST:
-            # Shutdown-Powerup check
-            # Compare current power to minimum power and increment/decrement
-            # counter.
-            # If counter exceeds limits, shutdown/startup client.
-
-            if power_target < MIN_POWER and powered:
-                power_counter -= 1
-            else:
-                power_counter = 0
-            if power_target > MIN_POWER and not powered:
-                power_counter += 1
-            else:
-                power_counter = 0
-
-            if power_counter > ON_LIMIT:
-                pwr.power_on()
-                processor_limits[1] = 1
-                powered = 1
-
-            elif power_counter < OFF_LIMIT:
-                pwr.power_off()
-                processor_limits[1] = 0
-                udpcomms.send_msg("shutdown:")
-                powered = 0
-        elif mode == MODE_LIMIT_TEST and not powered:
-            pwr.power_on()
-            powered = 1
-
-        # Change adjust interval and ensure that the value stays sane when no
-        # adjustment is done to the system.
-        if adjust_interval > ADJUST_INTERVAL:
-            adjust_interval = 0
-        else:
-            adjust_interval += 1
-        # Issue commands to client
-        if powered:
-                udpcomms.send_msg("control:" + str(processor_limits[1]) + ":" +
-                                  str(processor_limits[0]))
-                # Poll computer for status
-                udpcomms.send_msg("status:")
-
-        # Rough estimate of system accuracy in long run.
-        budget += power_target - power
-        if DEBUG:
-            print("\n\n Current Power Budget: " + str(budget) + "\n")
+        if sel is not None and sel.select(0):
+            if sys.stdin.readline():
+                (st.mode, st.pid, st.processor_limits,
+                 st.manual_power_target) = interface(st.mode, st.pid,
+                                                     st.processor_limits,
+                                                     st.manual_power_target)
+                loop = LOOPS[st.mode]
+
+        loop(st)
+
+        # Sleep until the start of the next round
+        _sleep(max(0, PERIOD - (_monotonic() - t0)))
 
 
 if __name__ == "__main__":
     main()
-